@@ -13,7 +13,7 @@ setup(name='trelloapi',
       description="autogenerated trello API client for python",
       long_description=README + '\n\n' + CHANGELOG,
       classifiers=[
-          'Programming Language :: Python :: 3.4',
+          'Programming Language :: Python :: 3.7',
           'Development Status :: 4 - Beta',
           'License :: OSI Approved :: GNU Lesser General Public License v3 (LGPLv3)'
       ],
@@ -25,8 +25,13 @@ setup(name='trelloapi',
       packages=find_packages(exclude=["tests", "docs"]),
       include_package_data=True,
       zip_safe=False,
+      python_requires='>=3.7',
       install_requires=[
           'PyYAML==3.11',
+          'requests',
       ],
+      extras_require={
+          'http2': ['httpx[http2]'],
+      },
       entry_points={
       })
@@ -0,0 +1,224 @@
+"""
+Tests of the API client against a stub HTTP session.
+
+"""
+from types import SimpleNamespace
+from unittest import TestCase, mock
+
+from trelloapi import api
+
+
+class Response:
+    """
+    Minimal response: a status, headers and the JSON body of a batch.
+
+    """
+    def __init__(self, status_code=200, headers=None, results=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.results = results
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.results
+
+
+class Session:
+    """
+    Records the requests made and answers them with `status_code` and
+    `headers`. Batch requests get one result per route, except the first
+    `drop` ones.
+
+    """
+    def __init__(self, status_code=200, headers=None, drop=0):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.drop = drop
+        self.calls = []
+
+    def request(self, method, url, params=None, **kwargs):
+        self.calls.append((method, url, params, kwargs))
+        results = None
+        if params and 'urls' in params:
+            routes = params['urls'].split(',')[self.drop:]
+            results = [{'200': route} for route in routes]
+        return Response(self.status_code, dict(self.headers), results)
+
+
+class HTTPMethodTest(TestCase):
+    def setUp(self):
+        self.session = Session()
+        self.trello = api.TrelloAPIV1('APIKEY', session=self.session)
+
+    def test_positional_argument_is_the_body_of_writes(self):
+        self.trello.cards.post({'name': 'Card'})
+        self.assertEqual(
+            self.session.calls,
+            [('POST', 'https://trello.com/1/cards', {'key': 'APIKEY'},
+              {'data': {'name': 'Card'}})])
+
+    def test_positional_argument_is_the_params_of_reads(self):
+        params = {'fields': 'name'}
+        self.trello.boards(board_id='B').get(params)
+        self.assertEqual(self.session.calls[-1][2],
+                         {'fields': 'name', 'key': 'APIKEY'})
+        self.assertEqual(params, {'fields': 'name'})
+
+    def test_too_many_positional_arguments(self):
+        with self.assertRaises(TypeError):
+            self.trello.cards.post({'name': 'Card'}, {'idList': 'L'})
+        with self.assertRaises(TypeError):
+            self.trello.cards.post({'name': 'Card'}, data={'idList': 'L'})
+
+
+class HTTP2Test(TestCase):
+    def test_uses_an_http2_client(self):
+        client = mock.Mock()
+        fake_httpx = SimpleNamespace(Client=mock.Mock(return_value=client),
+                                     Limits=dict)
+        with mock.patch.object(api, 'httpx', fake_httpx):
+            trello = api.TrelloAPIV1('APIKEY', http2=True)
+            trello.boards(board_id='B').get(params={'fields': 'name'})
+
+        self.assertIs(fake_httpx.Client.call_args[1]['http2'], True)
+        client.request.assert_called_once_with(
+            'GET', 'https://trello.com/1/boards/B',
+            params={'fields': 'name', 'key': 'APIKEY'})
+
+    def test_requires_httpx(self):
+        with mock.patch.object(api, 'httpx', None):
+            with self.assertRaises(ImportError):
+                api.TrelloAPIV1('APIKEY', http2=True)
+
+
+class BatchTest(TestCase):
+    def setUp(self):
+        self.session = Session()
+        self.trello = api.TrelloAPIV1('APIKEY', session=self.session)
+
+    def test_requests_are_sent_in_chunks(self):
+        with self.trello.batched():
+            boards = [self.trello.boards(board_id=i).get()
+                      for i in range(1, 13)]
+        self.assertEqual(boards[0].result(), {'200': '/boards/1'})
+        self.assertEqual(boards[-1].result(), {'200': '/boards/12'})
+        self.assertEqual(
+            [params['urls'].count(',') + 1
+             for _, _, params, _ in self.session.calls],
+            [api.BATCH_SIZE, 12 - api.BATCH_SIZE])
+
+    def test_nested_blocks_are_sent_by_the_outermost(self):
+        with self.trello.batched():
+            board = self.trello.boards(board_id='B').get()
+            with self.trello.batched():
+                me = self.trello.members(id_member_or_username='me').get(
+                    params={'fields': 'id'})
+            self.assertFalse(me.done())
+        self.assertEqual(me.result(), {'200': '/members/me?fields=id'})
+        self.assertEqual(board.result(), {'200': '/boards/B'})
+        self.assertEqual(len(self.session.calls), 1)
+
+    def test_requests_keep_the_credentials_of_their_instance(self):
+        other_session = Session()
+        other = api.TrelloAPIV1('OTHER', session=other_session)
+        with self.trello.batched():
+            self.trello.boards(board_id='A').get()
+            other.boards(board_id='B').get()
+        self.assertEqual(
+            self.session.calls,
+            [('GET', 'https://trello.com/1/batch',
+              {'key': 'APIKEY', 'urls': '/boards/A'}, {})])
+        self.assertEqual(
+            other_session.calls,
+            [('GET', 'https://trello.com/1/batch',
+              {'key': 'OTHER', 'urls': '/boards/B'}, {})])
+
+    def test_nothing_is_sent_if_the_block_fails(self):
+        with self.assertRaises(KeyError):
+            with self.trello.batched():
+                board = self.trello.boards(board_id='A').get()
+                raise KeyError('A')
+        self.assertTrue(board.cancelled())
+        self.assertEqual(self.session.calls, [])
+
+    def test_missing_results_are_errors(self):
+        trello = api.TrelloAPIV1('APIKEY', session=Session(drop=1))
+        with self.assertRaisesRegex(ValueError, '0 results for 1'):
+            with trello.batched():
+                board = trello.boards(board_id='A').get()
+        self.assertIsInstance(board.exception(), ValueError)
+
+    def test_sequence_params_are_sent_as_repeated_fields(self):
+        with self.trello.batched():
+            board = self.trello.boards(board_id='B').get(
+                params={'fields': ['name', 'desc']})
+        self.assertEqual(board.result(),
+                         {'200': '/boards/B?fields=name&fields=desc'})
+
+
+class ResponseCacheTest(TestCase):
+    def setUp(self):
+        self.session = Session()
+        self.trello = api.TrelloAPIV1('APIKEY', session=self.session,
+                                      cache_size=8)
+        self.board = self.trello.boards(board_id='B')
+
+    def test_responses_are_reused(self):
+        self.assertIs(self.board.get(), self.board.get())
+        self.assertIsNot(self.board.get(params={'fields': 'name'}),
+                         self.board.get())
+        self.assertEqual(len(self.session.calls), 2)
+
+    def test_writes_and_cache_clear_empty_the_cache(self):
+        self.board.get()
+        self.board.put(params={'name': 'New name'})
+        self.board.get()
+        self.assertEqual(len(self.session.calls), 3)
+        self.trello.cache_clear()
+        self.board.get()
+        self.assertEqual(len(self.session.calls), 4)
+
+    def test_no_store_responses_are_not_cached(self):
+        self.session.headers = {'Cache-Control': 'no-store'}
+        self.assertIsNot(self.board.get(), self.board.get())
+        self.assertEqual(len(self.session.calls), 2)
+
+    def test_errors_are_not_cached(self):
+        self.session.status_code = 404
+        self.assertIsNot(self.board.get(), self.board.get())
+        self.assertEqual(len(self.session.calls), 2)
+
+    def test_params_that_can_not_be_a_key_skip_the_cache(self):
+        self.board.get(params={1: 'a', 'x': 'b'})
+        self.board.get(params={'fields': ['name', 'desc']})
+        self.assertEqual(len(self.session.calls), 2)
+
+    def test_max_age_expires_the_response(self):
+        self.session.headers = {'Cache-Control': 'private, max-age=60'}
+        with mock.patch.object(api, 'monotonic', return_value=100):
+            self.board.get()
+            self.board.get()
+        self.assertEqual(len(self.session.calls), 1)
+        with mock.patch.object(api, 'monotonic', return_value=161):
+            self.board.get()
+        self.assertEqual(len(self.session.calls), 2)
+
+    def test_cache_ttl_expires_responses_without_max_age(self):
+        trello = api.TrelloAPIV1('APIKEY', session=self.session,
+                                 cache_size=8, cache_ttl=5)
+        board = trello.boards(board_id='B')
+        with mock.patch.object(api, 'monotonic', return_value=100):
+            board.get()
+            board.get()
+        self.assertEqual(len(self.session.calls), 1)
+        with mock.patch.object(api, 'monotonic', return_value=106):
+            board.get()
+        self.assertEqual(len(self.session.calls), 2)
+
+    def test_max_age_zero_is_not_cached(self):
+        self.session.headers = {'Cache-Control': 'max-age=0'}
+        self.board.get()
+        self.board.get()
+        self.assertEqual(len(self.session.calls), 2)
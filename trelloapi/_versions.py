@@ -0,0 +1,2 @@
+# Generated by make_endpoints.py. Do not edit.
+VERSIONS = ('1',)
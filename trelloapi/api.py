@@ -3,22 +3,354 @@
 Trello API.
 
 """
-from functools import partial
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from time import monotonic
+from urllib.parse import urlencode
+from weakref import WeakValueDictionary
 import os
-import gzip
-from base64 import b64decode
+import hashlib
+import mmap
+import pickle
+import struct
+import zlib
 
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 import requests
 import yaml
 
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from ._versions import VERSIONS
+
 __all__ = []
 
 TRELLO_URL = 'https://trello.com/'
 HERE = os.path.dirname(__file__)
+BATCH_SIZE = 10  # Routes accepted by Trello in a single batch request.
+
+# GET requests waiting for TrelloAPI.batched(), as (request, batch_url,
+# auth, route, future) tuples.
+_batch_ctx = ContextVar('trelloapi_batch', default=None)
+
+
+with open(os.path.join(HERE, 'endpoints.docs.bin'), 'rb') as docs_file:
+    DOCS = mmap.mmap(docs_file.fileno(), 0, access=mmap.ACCESS_READ)
 
-with open(os.path.join(HERE, 'endpoints.yaml'), 'rb') as ep_file:
-    ENDPOINTS = yaml.load(ep_file.read())
 
+def _unpack_doc(offset):
+    """
+    Reads the raw deflate documentation blob stored at `offset` of DOCS.
+
+    """
+    length, = struct.unpack_from('>I', DOCS, offset)
+    start = offset + 4
+    return zlib.decompress(DOCS[start:start + length], -15).decode('utf-8')
+
+
+def _classify(endpoints):
+    """
+    Splits every node of the tree into its HTTP methods (`__methods__`),
+    URL arguments (`__args__`) and static sub-paths (`__children__`).
+
+    """
+    node = {'__methods__': {}, '__args__': {}, '__children__': {}}
+    for name, content in endpoints.items():
+        if name == 'METHODS':
+            node['__methods__'].update(content)
+        elif name.startswith('_') and name.endswith('_'):
+            node['__args__'][name.strip('_')] = _classify(content)
+        else:
+            node['__children__'][name] = _classify(content)
+    return node
+
+
+def _load_endpoints():
+    """
+    Loads the endpoint tree.
+
+    The pickled copy written by `make_endpoints` is used when it was built
+    from the current endpoints.yaml; otherwise the YAML is parsed.
+
+    """
+    with open(os.path.join(HERE, 'endpoints.yaml'), 'rb') as ep_file:
+        raw = ep_file.read()
+
+    try:
+        with open(os.path.join(HERE, 'endpoints.pkl'), 'rb') as pkl_file:
+            digest, endpoints = pickle.load(pkl_file)
+    except Exception:
+        # Missing, truncated or malformed pickle: parse the YAML instead.
+        pass
+    else:
+        if digest == hashlib.sha1(raw).hexdigest():
+            return endpoints
+
+    return yaml.load(raw, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+
+ENDPOINTS = {version: _classify(endpoints)
+             for version, endpoints in _load_endpoints().items()}
+
+
+def _make_session():
+    """
+    Creates an HTTP session keeping pooled connections alive to Trello.
+
+    """
+    # Transient server errors are retried with a short backoff. The last
+    # response is still returned as is, and Retry-After is not honoured
+    # so a call never blocks for a server-chosen time.
+    retries = Retry(total=3, backoff_factor=0.3,
+                    status_forcelist=(500, 502, 503, 504),
+                    raise_on_status=False,
+                    respect_retry_after_header=False)
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20,
+                          max_retries=retries)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    return session
+
+
+def _make_http2_client():
+    """
+    Creates an httpx client multiplexing the requests to Trello over a
+    single HTTP/2 connection. Needs the optional `http2` dependencies.
+
+    """
+    if httpx is None:
+        raise ImportError(
+            "HTTP/2 support requires httpx: pip install trelloapi[http2]")
+    return httpx.Client(
+        http2=True, limits=httpx.Limits(max_keepalive_connections=20))
+
+
+class _ResponseCache:
+    """
+    LRU cache of GET responses, keyed by URL and sorted params items.
+
+    Responses are kept as the session returned them, so callers get the
+    same type of response whether it came from the cache or not. Errors and
+    responses marked `no-store` or `no-cache` are not kept; the others
+    expire after their `max-age`, or after `ttl` seconds if they have none
+    (never if `ttl` is None).
+
+    """
+    def __init__(self, session, maxsize, ttl=None):
+        self._session = session
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, url, params):
+        key = (url, params)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                response, expires = entry
+                if expires is None or monotonic() < expires:
+                    self._entries.move_to_end(key)
+                    return response
+                del self._entries[key]
+
+        response = self._session.request('GET', url, params=dict(params))
+
+        lifetime = self._lifetime(response)
+        if lifetime == 0:
+            return response
+
+        expires = None if lifetime is None else monotonic() + lifetime
+        with self._lock:
+            self._entries[key] = (response, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+        return response
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _lifetime(self, response):
+        """
+        Seconds `response` may be reused for: 0 if it must not be cached,
+        None if it does not expire.
+
+        """
+        if not 200 <= response.status_code < 300:
+            return 0
+
+        directives = {}
+        for directive in response.headers.get('Cache-Control', '').split(','):
+            name, _, value = directive.strip().lower().partition('=')
+            directives[name] = value.strip('"')
+
+        if 'no-store' in directives or 'no-cache' in directives:
+            return 0
+        elif 'max-age' in directives:
+            try:
+                return max(int(directives['max-age']), 0)
+            except ValueError:
+                return 0
+        return self._ttl
+
+
+def _send_batch(pending):
+    """
+    Sends the queued GET requests through Trello's batch endpoint, grouped
+    by session, credentials and API version, BATCH_SIZE routes at a time,
+    and resolves their futures.
+
+    """
+    groups = {}
+    for request, batch_url, auth, route, future in pending:
+        key = (request, batch_url, tuple(sorted(auth.items())))
+        groups.setdefault(key, []).append((route, future))
+
+    try:
+        for (request, batch_url, auth), entries in groups.items():
+            for start in range(0, len(entries), BATCH_SIZE):
+                chunk = entries[start:start + BATCH_SIZE]
+                response = request(
+                    'GET', batch_url,
+                    params=dict(auth, urls=','.join(r for r, _ in chunk)))
+                response.raise_for_status()
+                results = response.json()
+                if len(results) != len(chunk):
+                    raise ValueError(
+                        "Trello returned {} results for {} batched "
+                        "routes".format(len(results), len(chunk)))
+
+                for (_, future), result in zip(chunk, results):
+                    future.set_result(result)
+    except Exception as exc:
+        for *_, future in pending:
+            if not future.done():
+                future.set_exception(exc)
+        raise
+
+
+class APIMethod:
+    # HTTP method of an endpoint.
+    #
+    # The session's request function, the URL and the credentials are bound
+    # at construction, so a call goes straight to the session. The
+    # endpoint documentation is only decompressed the first time `__doc__`
+    # is read (e.g. by `help()`); that property is why this class has no
+    # docstring of its own.
+    #
+    # As with `requests.post(url, data)`, a single positional argument is
+    # accepted: the body of POST, PUT and PATCH, or the params of other
+    # methods. Everything else is forwarded to the session's `request` as
+    # keywords (httpx takes no other positional argument).
+    __slots__ = ('_request', '_http_method', '_url', '_auth', '_doc_offset',
+                 '_doc', '_invalidate', '_positional')
+
+    def __init__(self, request, http_method, url, auth, doc_offset,
+                 invalidate=None):
+        self._request = request
+        self._http_method = http_method
+        self._url = url
+        self._auth = auth
+        self._doc_offset = doc_offset
+        self._doc = None
+        # Called after each request; writes use it to drop cached GETs.
+        self._invalidate = invalidate
+        # Keyword receiving the single positional argument.
+        if http_method in ('POST', 'PUT', 'PATCH'):
+            self._positional = 'data'
+        else:
+            self._positional = 'params'
+
+    def _bind_positional(self, args, kwargs):
+        """
+        Moves the positional argument into `kwargs` under its keyword.
+
+        """
+        if len(args) > 1 or self._positional in kwargs:
+            raise TypeError(
+                "{} takes one positional argument ({}), got {}".format(
+                    self._http_method.lower(), self._positional,
+                    len(args) + (self._positional in kwargs)))
+        kwargs[self._positional] = args[0]
+
+    def __call__(self, *args, **kwargs):
+        if args:
+            self._bind_positional(args, kwargs)
+
+        # The caller's params are copied, never updated in place.
+        params = kwargs.pop('params', None)
+        params = dict(params, **self._auth) if params else self._auth
+
+        response = self._request(self._http_method, self._url, params=params,
+                                 **kwargs)
+        if self._invalidate is not None:
+            self._invalidate()
+        return response
+
+    @property
+    def __doc__(self):
+        if self._doc is None:
+            self._doc = _unpack_doc(self._doc_offset)
+        return self._doc
+
+
+class GETMethod(APIMethod):
+    # GET method of an endpoint, which may be answered by the response
+    # cache or queued by `TrelloAPI.batched()`. Only plain calls (no
+    # arguments besides `params`) are cached or queued.
+    __slots__ = ('_cached_get', '_route', '_batch_url')
+
+    # A class docstring, or none at all (which sets `__doc__` to None),
+    # would hide the lazy `__doc__` property inherited from APIMethod.
+    __doc__ = APIMethod.__doc__
+
+    def __init__(self, request, url, auth, doc_offset, cached_get, route,
+                 batch_url):
+        super().__init__(request, 'GET', url, auth, doc_offset)
+        self._cached_get = cached_get
+        self._route = route
+        self._batch_url = batch_url
+
+    def __call__(self, *args, **kwargs):
+        if args:
+            self._bind_positional(args, kwargs)
+
+        if kwargs.keys() - {'params'}:
+            return APIMethod.__call__(self, **kwargs)
+
+        params = kwargs.get('params')
+
+        pending = _batch_ctx.get()
+        if pending is not None:
+            future = Future()
+            route = (self._route + '?' + urlencode(params, doseq=True)
+                     if params else self._route)
+            pending.append((self._request, self._batch_url, self._auth, route,
+                            future))
+            return future
+
+        if self._cached_get is not None:
+            try:
+                key = tuple(sorted(dict(params, **self._auth).items()
+                                   if params else self._auth.items()))
+                hash(key)
+            except TypeError:
+                # Params that can not be sorted or hashed can not be part
+                # of the cache key.
+                pass
+            else:
+                return self._cached_get(self._url, key)
+
+        return APIMethod.__call__(self, **kwargs)
 
 
 class TrelloAPI:
@@ -28,8 +360,14 @@ class TrelloAPI:
     Dynamically generates methods corresponding with API URLs.
 
     """
+    __slots__ = ('_endpoints', '_name', '_apikey', '_token', '_parent',
+                 '_api_arg', '_session', '_url', '_allowed_args',
+                 '_static_children', '_child_cache', '_method_fns',
+                 '_arg_cache', '_get_cache', '_auth', '__weakref__')
+
     def __init__(self, endpoints, name, apikey, parent=None, api_arg=None,
-                 token=None):
+                 token=None, session=None, http2=False, cache_size=0,
+                 cache_ttl=None):
         self._endpoints = endpoints
         self._name = name
         self._apikey = apikey
@@ -37,94 +375,218 @@ class TrelloAPI:
         self._parent = parent
         self._api_arg = api_arg
 
-        self._allowed_args = []
-
-        for name, content in self._endpoints.items():
-            if name == 'METHODS':
-                # Métodos HTTP de este endpoint.
-                for api_method, doc in content:
-                    name = api_method.lower()
-                    obj_method = partial(self._api_call, name)
-                    obj_method.__doc__ = self._unpack_doc(doc)
-                    setattr(self, name, obj_method)
-            elif name.startswith('_') and name.endswith('_'):
-                # Argumento de la API
-                self._allowed_args.append(name.strip('_'))
-            else:
-                # Path parcial de la API.
-                next_path = TrelloAPI(endpoints=self._endpoints[name],
-                                      name=name,
-                                      apikey=self._apikey,
-                                      parent=self,
-                                      token=self._token)
-                setattr(self, name, next_path)
-
-    @staticmethod
-    def _unpack_doc(b64):
-        return gzip.decompress(b64decode(b64)).decode('utf-8')
+        # The whole tree shares the HTTP session of its root.
+        if self._parent:
+            self._session = self._parent._session
+        elif session is not None:
+            self._session = session
+        elif http2:
+            self._session = _make_http2_client()
+        else:
+            self._session = _make_session()
 
-    @property
-    def _url(self):
-        """
-        Resolve the URL to this point.
+        # Credentials sent with every request, also shared by the whole tree.
+        if self._parent:
+            self._auth = self._parent._auth
+        else:
+            self._auth = {'key': self._apikey}
+            if self._token is not None:
+                self._auth['token'] = self._token
 
-        >>> trello = TrelloAPIV1('APIKEY')
-        >>> trello.batch._url
-        '1/batch'
-        >>> trello.boards(board_id='BOARD_ID')._url
-        '1/boards/BOARD_ID'
-        >>> trello.boards(board_id='BOARD_ID')(field='FIELD')._url
-        '1/boards/BOARD_ID/FIELD'
-        >>> trello.boards(board_id='BOARD_ID').cards(filter='FILTER')._url
-        '1/boards/BOARD_ID/cards/FILTER'
+        # Opt-in cache of GET responses, also shared by the whole tree.
+        if self._parent:
+            self._get_cache = self._parent._get_cache
+        elif cache_size:
+            self._get_cache = _ResponseCache(self._session, cache_size,
+                                             cache_ttl)
+        else:
+            self._get_cache = None
 
-        """
+        # The parent chain never changes, so the URL is resolved only once.
         if self._api_arg:
             mypart = str(self._api_arg)
         else:
             mypart = self._name
 
         if self._parent:
-            return '/'.join(filter(None, [self._parent._url, mypart]))
+            self._url = '/'.join(filter(None, [self._parent._url, mypart]))
         else:
-            return mypart
+            self._url = mypart
+
+        # Argumentos de la API.
+        self._allowed_args = frozenset(self._endpoints['__args__'])
+        # Paths parciales de la API (se construyen al primer acceso).
+        self._static_children = self._endpoints['__children__']
+        self._child_cache = {}
+        # Nodes with an URL argument are only reused while someone holds
+        # them; otherwise every ID ever used would stay alive.
+        self._arg_cache = WeakValueDictionary()
+
+        # Métodos HTTP de este endpoint.
+        self._method_fns = {}
+        for api_method, doc in self._endpoints['__methods__'].items():
+            obj_method = self._api_call(api_method.upper(), doc)
+            self._method_fns[api_method.lower()] = obj_method
+
+    def __getattr__(self, name):
+        """
+        Resolves HTTP methods and static sub-paths, building the latter on
+        first access.
+
+        """
+        if name.startswith('_'):
+            # Slots not yet assigned end up here too.
+            raise AttributeError(name)
+        elif name in self._method_fns:
+            return self._method_fns[name]
+        elif name not in self._static_children:
+            raise AttributeError(name)
+
+        key = (name, None)
+        if key not in self._child_cache:
+            self._child_cache[key] = TrelloAPI(
+                endpoints=self._static_children[name],
+                name=name,
+                apikey=self._apikey,
+                parent=self,
+                token=self._token)
+        return self._child_cache[key]
+
+    def __dir__(self):
+        return sorted(set(super().__dir__()) | set(self._method_fns) |
+                      set(self._static_children))
+
+    def _api_call(self, http_method, doc_offset):
+        """
+        Returns the callable making the HTTP request to this URL.
+
+        """
+        url = TRELLO_URL + self._url
+        if http_method != 'GET':
+            # Any write may change what cached GETs would return.
+            invalidate = (self._get_cache.clear
+                          if self._get_cache is not None else None)
+            return APIMethod(self._session.request, http_method, url,
+                             self._auth, doc_offset, invalidate)
+
+        # Route of this URL for the batch endpoint (without the version).
+        version, _, route = self._url.partition('/')
+        cached_get = (self._get_cache.get
+                      if self._get_cache is not None else None)
+        return GETMethod(self._session.request, url, self._auth, doc_offset,
+                         cached_get, '/' + route,
+                         TRELLO_URL + version + '/batch')
+
+    @contextmanager
+    def batched(self):
+        """
+        Groups the GET requests made inside the block into requests to
+        Trello's batch endpoint, up to BATCH_SIZE routes each.
+
+        Inside the block, GET methods return a `concurrent.futures.Future`
+        that is resolved with Trello's result for that route (e.g.
+        ``{'200': {...}}``) when the block exits. Blocks may be nested; the
+        requests are sent when the outermost one exits. Each request goes
+        through the session and credentials of the API instance it was
+        made on.
+
+        >>> trello = TrelloAPIV1('APIKEY', 'TOKEN')
+        >>> with trello.batched():  # doctest: +SKIP
+        ...     boards = [trello.boards(board_id=board_id).get()
+        ...               for board_id in ('A', 'B', 'C')]
+        >>> [board.result()['200']['name']
+        ...  for board in boards]  # doctest: +SKIP
+        ['Board A', 'Board B', 'Board C']
 
-    def _api_call(self, method_name, *args, **kwargs):
         """
-        Makes the HTTP request.
+        if _batch_ctx.get() is not None:
+            yield
+            return
+
+        pending = []
+        ctx_token = _batch_ctx.set(pending)
+        try:
+            yield
+        except BaseException:
+            for *_, future in pending:
+                future.cancel()
+            raise
+        finally:
+            _batch_ctx.reset(ctx_token)
+
+        _send_batch(pending)
 
+    def cache_clear(self):
         """
-        params = kwargs.setdefault('params', {})
-        params.update({'key': self._apikey})
-        if self._token is not None:
-            params.update({'token': self._token})
+        Empties the GET response cache of this API instance.
 
-        http_method = getattr(requests, method_name)
-        return http_method(TRELLO_URL + self._url, *args, **kwargs)
+        The cache is enabled with `cache_size` (`cache_ttl` bounds the life
+        of responses without a Cache-Control max-age) and is also emptied
+        by every PUT, POST or DELETE made through the same instance.
+
+        >>> trello = TrelloAPIV1('APIKEY', 'TOKEN', cache_size=64)
+        >>> board = trello.boards(board_id='B')
+        >>> board.get() is board.get()  # doctest: +SKIP
+        True
+        >>> trello.cache_clear()
+
+        """
+        if self._get_cache is not None:
+            self._get_cache.clear()
 
     def __call__(self, **kwargs):
         """
         Adds a variable parameter to the API URL.
 
+        The node is reused while it is referenced elsewhere:
+
+        >>> trello = TrelloAPIV1('APIKEY')
+        >>> board = trello.boards(board_id='BOARD_ID')
+        >>> trello.boards(board_id='BOARD_ID') is board
+        True
+        >>> trello.boards(board_id=1), trello.boards(board_id=True)
+        (TrelloQuery <"1/boards/1">, TrelloQuery <"1/boards/True">)
+
         """
         if not kwargs:
             raise ValueError("A keyword argument must be provided: {}".format(
-                                ', '.join(self._allowed_args)))
+                                ', '.join(sorted(self._allowed_args))))
         elif len(kwargs) > 1:
             raise ValueError("Too many arguments.")
-        elif set(kwargs.keys()) <= set(self._allowed_args):
-            _name, _api_arg = list(kwargs.items())[0]
-            name = '_' + _name + '_'
-            return TrelloAPI(endpoints=self._endpoints[name],
-                             name=name,
-                             apikey=self._apikey,
-                             parent=self,
-                             api_arg=_api_arg,
-                             token=self._token)
-        else:
+
+        (_name, _api_arg), = kwargs.items()
+        if _name not in self._allowed_args:
             raise ValueError("Unknown argument {}".format(kwargs.keys()))
 
+        name = '_' + _name + '_'
+        # Keyed like the URL is built, so 1, 1.0 and True stay apart.
+        key = (name, str(_api_arg))
+        next_path = self._arg_cache.get(key)
+        if next_path is None:
+            next_path = TrelloAPI(endpoints=self._endpoints['__args__'][_name],
+                                  name=name,
+                                  apikey=self._apikey,
+                                  parent=self,
+                                  api_arg=_api_arg,
+                                  token=self._token)
+            self._arg_cache[key] = next_path
+        return next_path
+
     def __repr__(self):
+        """
+        Shows the URL resolved to this point.
+
+        >>> trello = TrelloAPIV1('APIKEY')
+        >>> trello.batch
+        TrelloQuery <"1/batch">
+        >>> trello.boards(board_id='BOARD_ID')
+        TrelloQuery <"1/boards/BOARD_ID">
+        >>> trello.boards(board_id='BOARD_ID')(field='FIELD')
+        TrelloQuery <"1/boards/BOARD_ID/FIELD">
+        >>> trello.boards(board_id='BOARD_ID').cards(filter='FILTER')
+        TrelloQuery <"1/boards/BOARD_ID/cards/FILTER">
+
+        """
         return 'TrelloQuery <"{}">'.format(self._url)
 
 
@@ -133,9 +595,18 @@ def generate_api(version):
     Generates a factory function to instantiate the API with the given
     version.
 
+    >>> trello = generate_api('1')('APIKEY', 'TOKEN')
+    >>> sorted(trello._auth.items())
+    [('key', 'APIKEY'), ('token', 'TOKEN')]
+
     """
-    def get_partial_api(key, token=None):
-        return TrelloAPI(ENDPOINTS[version], version, key, token=token)
+    endpoints = ENDPOINTS[version]
+
+    def get_partial_api(key, token=None, *, session=None, http2=False,
+                        cache_size=0, cache_ttl=None):
+        return TrelloAPI(endpoints, version, key, token=token,
+                         session=session, http2=http2, cache_size=cache_size,
+                         cache_ttl=cache_ttl)
 
     get_partial_api.__doc__ = \
         """Interfaz REST con Trello. Versión {}""".format(version)
@@ -143,9 +614,10 @@ def generate_api(version):
     return get_partial_api
 
 #
-# Generate and register a TrelloAPI class for each version.
+# Generate and register a TrelloAPI class for each version listed by
+# make_endpoints.
 #
-for version in ENDPOINTS.keys():
+for version in VERSIONS:
     api_cls = generate_api(version)
     api_name = 'TrelloAPIV{}'.format(version)
 
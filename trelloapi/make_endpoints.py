@@ -4,24 +4,39 @@ Translate the documentation of Trello API into a YAML structure with all
 the information needed by the api module.
 
 """
-from base64 import b64encode
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from lxml import html
 from pprint import pprint
-import gzip
+import hashlib
+import os
+import pickle
 import re
+import struct
+import zlib
 
 from html2text import html2text
 from lxml import etree
+from requests.adapters import HTTPAdapter
 import requests
 import yaml
 
+HERE = os.path.dirname(__file__)
+ENDPOINTS_YAML = os.path.join(HERE, 'endpoints.yaml')
+ENDPOINTS_PKL = os.path.join(HERE, 'endpoints.pkl')
+ENDPOINTS_DOCS = os.path.join(HERE, 'endpoints.docs.bin')
+VERSIONS_PY = os.path.join(HERE, '_versions.py')
+
 TRELLO_API_DOC = 'https://trello.com/docs/api/'
+FETCH_WORKERS = 16
 HTTP_METHODS = {'OPTIONS', 'GET', 'HEAD', 'POST', 'PUT', 'DELETE',
                 'TRACE', 'CONNECT'}
+# Matched against the text of a section header, anchored at its start.
 EP_DESC_REGEX = re.compile(
-    '.*({methods})\s([\/a-zA-Z0-9\[\]\s_]+).*'.format(
-        methods='|'.join(HTTP_METHODS)))
+    r'\s*({methods})\s+([/a-zA-Z0-9\[\]\s_]+)'.format(
+        methods='|'.join(HTTP_METHODS)),
+    re.ASCII)
+NON_LOWER_REGEX = re.compile(r'[^a-z]')
 
 def _is_url_arg(p):
     """
@@ -49,23 +64,50 @@ def _is_api_definition(line):
     return line.split(' ', 1)[0] in HTTP_METHODS
 
 
+def _non_lower_to_underscore(match):
+    """
+    Replacement for NON_LOWER_REGEX: an underscore, followed by the letter
+    in lowercase if the matched character is one.
+
+    """
+    char = match.group()
+    if char.isalpha():
+        return '_' + char.lower()
+    return '_'
+
+
 def _camelcase_to_underscore(url):
     """
     Translate camelCase into underscore format.
 
     >>> _camelcase_to_underscore('minutesBetweenSummaries')
     'minutes_between_summaries'
+    >>> _camelcase_to_underscore('[idAction]')
+    '_id_action_'
+
+    """
+    return NON_LOWER_REGEX.sub(_non_lower_to_underscore, url)
+
 
+def _pack_doc(docs, text):
     """
-    def upper2underscore(text):
-        for char in text:
-            if char.islower():
-                yield char
-            else:
-                yield '_'
-                if char.isalpha():
-                    yield char.lower()
-    return ''.join(upper2underscore(url))
+    Appends the documentation `text` to the `docs` buffer as a raw deflate
+    blob prefixed by its length, and returns the offset where it starts.
+
+    >>> import zlib
+    >>> docs = bytearray()
+    >>> _pack_doc(docs, 'GET /1/batch'), _pack_doc(docs, 'GET /1/types')
+    (0, 18)
+    >>> zlib.decompress(docs[22:], -15)
+    b'GET /1/types'
+
+    """
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    blob = compressor.compress(text.encode('utf-8')) + compressor.flush()
+
+    offset = len(docs)
+    docs += struct.pack('>I', len(blob)) + blob
+    return offset
 
 
 def create_tree(endpoints):
@@ -73,13 +115,13 @@ def create_tree(endpoints):
     Creates the Trello endpoint tree.
 
     >>> r = {'1': { \
-                 'actions': {'METHODS': {'GET'}}, \
-                 'boards': { \
-                     'members': {'METHODS': {'DELETE'}}}} \
+                 'actions': {'_id_action_': {'METHODS': {'GET': 'A'}}}, \
+                 'boards': {'_board_id_': {'members': {'_id_member_': { \
+                     'METHODS': {'DELETE': 'B'}}}}}} \
             }
     >>> r == create_tree([ \
-                 'GET /1/actions/[idAction]', \
-                 'DELETE /1/boards/[board_id]/members/[idMember]'])
+                 ('GET', '/1/actions/[idAction]', 'A'), \
+                 ('DELETE', '/1/boards/[board_id]/members/[idMember]', 'B')])
     True
 
     """
@@ -101,43 +143,80 @@ def create_tree(endpoints):
             here = here[part]
 
         # Allowed HTTP methods.
-        if not 'METHODS' in here:
-            here['METHODS'] = [[method, doc]]
-        else:
-            if not method in here['METHODS']:
-                here['METHODS'].append([method, doc])
+        here.setdefault('METHODS', {})[method] = doc
 
     return tree
 
 
+def write_endpoints(tree, docs):
+    """
+    Writes the endpoint tree as YAML, along with a pickled copy for fast
+    loading. The pickle records the digest of the YAML it matches.
+
+    The tree refers to the documentation by offset into `docs`, which is
+    written as a separate binary file. The API versions are written as a
+    Python module for api.py to import.
+
+    """
+    with open(VERSIONS_PY, 'w') as versions_file:
+        versions_file.write(
+            '# Generated by make_endpoints.py. Do not edit.\n'
+            'VERSIONS = {!r}\n'.format(tuple(sorted(tree))))
+
+    with open(ENDPOINTS_DOCS, 'wb') as docs_file:
+        docs_file.write(docs)
+
+    dump = yaml.dump(tree).encode('utf-8')
+    with open(ENDPOINTS_YAML, 'wb') as yaml_file:
+        yaml_file.write(dump)
+
+    # Written aside and then moved, so an interrupted run never leaves a
+    # truncated pickle behind.
+    tmp_pkl = ENDPOINTS_PKL + '.tmp'
+    with open(tmp_pkl, 'wb') as pkl_file:
+        pickle.dump((hashlib.sha1(dump).hexdigest(), tree), pkl_file,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_pkl, ENDPOINTS_PKL)
+
+
 def main():
     """
-    Prints the complete YAML.
+    Writes the complete endpoint tree.
 
     """
-    ep = requests.get(TRELLO_API_DOC).content
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=1,
+                                          pool_maxsize=FETCH_WORKERS))
+
+    ep = session.get(TRELLO_API_DOC).content
     root = html.fromstring(ep)
 
     links = root.xpath('//a[contains(@class, "reference internal")]/@href')
-    pages = [requests.get(TRELLO_API_DOC + u)
-             for u in links if u.endswith('index.html')]
+    urls = [TRELLO_API_DOC + u for u in links if u.endswith('index.html')]
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        pages = list(executor.map(session.get, urls))
 
     endpoints = []
+    docs = bytearray()
     for page in pages:
         root = html.fromstring(page.content)
         sections = root.xpath('//div[@class="section"]/h2/..')
         for sec in sections:
-            ep_html = etree.tostring(sec).decode('utf-8')
-            ep_text = html2text(ep_html).splitlines()
-            match = EP_DESC_REGEX.match(ep_text[0])
+            header = ''.join(sec.xpath('./h2//text()'))
+            match = EP_DESC_REGEX.match(header)
             if not match:
                 continue
             ep_method, ep_url = match.groups()
+            ep_url = ep_url.strip()
+
+            # Only endpoint sections pay for the markdown conversion.
+            ep_html = etree.tostring(sec).decode('utf-8')
+            ep_text = html2text(ep_html).splitlines()
             ep_text[0] = ' '.join([ep_method, ep_url])
-            ep_doc = b64encode(gzip.compress('\n'.join(ep_text).encode('utf-8')))
+            ep_doc = _pack_doc(docs, '\n'.join(ep_text))
             endpoints.append((ep_method, ep_url, ep_doc))
 
-    print(yaml.dump(create_tree(endpoints)))
+    write_endpoints(create_tree(endpoints), docs)
 
 
 if __name__ == '__main__':